@@ -1,9 +1,134 @@
 import streamlit as st
 import pandas as pd
 import io
-import re
 import numpy as np
-import time
+
+# Valid UK mobile, matched against the whole value: 07XXXXXXXXX (11 digits) or +447XXXXXXXXX (13 chars)
+UK_MOBILE_PATTERN = r"(?:07\d{9}|\+447\d{9})"
+# Characters stripped from mobile numbers before validation
+MOBILE_JUNK_CHARS = " -()"
+# First email-looking token in a cell, ignoring any surrounding text
+EMAIL_EXTRACT_PATTERN = r"([A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})"
+
+# Rows shown in the on-page previews; the download always contains every row
+PREVIEW_ROWS = 500
+# Rows encoded per chunk when writing the cleaned CSV for download
+CSV_CHUNK_ROWS = 50_000
+
+# Cached results hold patient data and are shared by every session, so keep only a few recent
+# uploads and drop them after an hour
+CACHE_MAX_ENTRIES = 4
+CACHE_TTL = "1h"
+
+REQUIRED_COLS = [
+    "NHS number",
+    "Preferred telephone number",
+    "Date of birth",
+    "First name",
+    "Email address"
+]
+
+
+def read_upload(raw: bytes) -> pd.DataFrame:
+    """Parse the required columns of an uploaded CSV into Arrow-backed columns."""
+    # Every column is read as text; inferring types would strip the leading 0 / "+" from
+    # NHS and mobile numbers and reformat dates. The C parser also tolerates short rows
+    # and quoted multi-line cells, which pyarrow's CSV reader rejects.
+    return pd.read_csv(
+        io.BytesIO(raw),
+        usecols=REQUIRED_COLS,
+        dtype=str,
+        dtype_backend="pyarrow",
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+def clean_csv(raw: bytes) -> tuple[pd.DataFrame, int, pd.DataFrame, list[str]]:
+    """Parse and clean an uploaded CSV for Accurx.
+
+    Returns a preview of the parsed upload, its row count, the cleaned frame and warning messages.
+    """
+    df = read_upload(raw)
+    uploaded_preview = df.head(PREVIEW_ROWS).copy()
+    uploaded_rows = len(df)
+    warnings = []
+
+    # Validate and clean UK mobile numbers (vectorized over the whole column).
+    # Skip the fixes entirely when every present number is already valid.
+    uploaded_mobiles = df["Preferred telephone number"].astype("string[pyarrow]")
+    if uploaded_mobiles.str.fullmatch(UK_MOBILE_PATTERN).all():
+        df["Preferred telephone number"] = uploaded_mobiles
+    else:
+        mobiles = uploaded_mobiles.str.strip()
+        # Correct O7/o7 to 07
+        mobiles = mobiles.str.replace(r"^[Oo]7", "07", regex=True)
+        # If starts with 7 and is 10 digits, prepend 0
+        mobiles = mobiles.mask(mobiles.str.fullmatch(r"7\d{9}").fillna(False), "0" + mobiles)
+        # Remove spaces, dashes, parentheses
+        for char in MOBILE_JUNK_CHARS:
+            mobiles = mobiles.str.replace(char, "", regex=False)
+        # Accept 07XXXXXXXXX or +447XXXXXXXXX in a single match, blank anything else
+        valid_mobiles = mobiles.str.fullmatch(UK_MOBILE_PATTERN).fillna(False)
+        mobiles = mobiles.where(valid_mobiles, np.nan)
+        # Warn about corrections and blanked numbers
+        # (rows are still in upload order with a default index, so positions are the row labels)
+        corrected = np.flatnonzero(((uploaded_mobiles != mobiles) & mobiles.notna()).to_numpy(dtype=bool, na_value=False))
+        blanked = np.flatnonzero((uploaded_mobiles.notna() & mobiles.isna()).to_numpy())
+        df["Preferred telephone number"] = mobiles
+        if corrected.size:
+            warnings.append(
+                "The following row(s) had their mobile number corrected to a valid UK format: " +
+                ", ".join(corrected.astype(str))
+            )
+        if blanked.size:
+            warnings.append(
+                "The following row(s) had invalid mobile numbers and have been blanked: " +
+                ", ".join(blanked.astype(str))
+            )
+
+    # Extract valid email from any cell with extra text (cells without one, e.g. "nan" or "", become NA),
+    # unless every present cell is already a bare email address
+    emails = df["Email address"].astype("string[pyarrow]")
+    if not emails.str.fullmatch(EMAIL_EXTRACT_PATTERN).all():
+        emails = emails.str.extract(EMAIL_EXTRACT_PATTERN, expand=False)
+    df["Email address"] = emails
+
+    # After extraction, warn if any are still blank (could not extract)
+    blanked_emails = np.flatnonzero(df["Email address"].isna().to_numpy()).tolist()
+    if blanked_emails:
+        warnings.append(
+            f"The following row(s) had no valid email address and have been left blank: {blanked_emails}"
+        )
+
+    # Check that NHS number is 10 digits long. The column is already an Arrow string column from
+    # the parser (kept as text so leading zeros survive), so it is matched directly without a cast;
+    # an integer range check would reject numbers starting with 0.
+    nhs_valid = df["NHS number"].str.fullmatch(r"\d{10}").to_numpy(dtype=bool, na_value=False)
+    dropped_count = np.count_nonzero(~nhs_valid)
+    if dropped_count > 0:
+        warnings.append(f"**{dropped_count}** row(s) dropped due to invalid NHS number (must be exactly 10 digits).")
+
+    # Check that each remaining row has a mobile number or email (both are blanked to NA when invalid)
+    mobile_ok = df["Preferred telephone number"].notna().to_numpy()
+    email_ok = df["Email address"].notna().to_numpy()
+    contact_ok = mobile_ok | email_ok
+    both_missing_count = np.count_nonzero(nhs_valid & ~contact_ok)
+    if both_missing_count > 0:
+        warnings.append(f"**{both_missing_count}** row(s) dropped because both mobile number and email address were missing.")
+
+    # Drop every failing row and keep only the required columns in a single filter
+    cleaned_df = df.loc[nhs_valid & contact_ok, REQUIRED_COLS].reset_index(drop=True)
+    return uploaded_preview, uploaded_rows, cleaned_df, warnings
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+def cleaned_csv(raw: bytes) -> bytes:
+    """Render the cleaned frame for an uploaded CSV as UTF-8 encoded CSV bytes, written in row chunks."""
+    _, _, cleaned_df, _ = clean_csv(raw)
+    csv_buffer = io.BytesIO()
+    cleaned_df.to_csv(csv_buffer, index=False, encoding="utf-8", chunksize=CSV_CHUNK_ROWS)
+    return csv_buffer.getvalue()
+
 
 st.set_page_config(page_title="SMS-Fix for Accurx", layout="centered")
 
@@ -19,119 +144,48 @@ uploaded_file = st.file_uploader("Upload CSV", type=["csv"])
 if uploaded_file is None:
     st.image("smsfix.png")
 else:
+    raw = uploaded_file.getvalue()
+
+    # Check for required columns (read the header only)
     try:
-        df = pd.read_csv(uploaded_file)
+        uploaded_cols = pd.read_csv(io.BytesIO(raw), nrows=0).columns
     except Exception:
         st.error("Could not read the CSV file. Please check the format.")
         st.stop()
-
-    # Display the uploaded data
-    st.subheader("Uploaded Data")
-    st.dataframe(df, height=200)
-    st.info(f"Uploaded DataFrame row count: **{df.shape[0]}**")
-
-    # Check for required columns
-    required_cols = [
-        "NHS number",
-        "Preferred telephone number",
-        "Date of birth",
-        "First name",
-        "Email address"
-    ]
-    missing_cols = [col for col in required_cols if col not in df.columns]
+    missing_cols = [col for col in REQUIRED_COLS if col not in uploaded_cols]
     if missing_cols:
         st.toast(f"Missing columns: {', '.join(missing_cols)}", icon=":material/build_circle:")
+        # Still show the upload as-is so the user can see which columns it does have,
+        # reading only its first rows rather than the whole file
+        st.subheader("Uploaded Data")
+        st.dataframe(pd.read_csv(io.BytesIO(raw), dtype=str, nrows=PREVIEW_ROWS), height=200)
+        st.caption(f"Showing up to the first {PREVIEW_ROWS} rows.")
         st.stop()
 
-    # Validate and clean UK mobile numbers
-
-    def clean_mobile(mobile):
-        if pd.isna(mobile):
-            return np.nan
-        s = str(mobile).strip()
-        # Correct O7/o7 to 07
-        if s.startswith("O7") or s.startswith("o7"):
-            s = "07" + s[2:]
-        # If starts with 7 and is 10 digits, prepend 0
-        if s.startswith("7") and len(s) == 10 and s.isdigit():
-            s = "0" + s
-        # Remove spaces, dashes, parentheses
-        s = re.sub(r"[ \-\(\)]", "", s)
-        # Accept 07XXXXXXXXX (11 digits) or +447XXXXXXXXX (13 chars)
-        if re.match(r"^07\d{9}$", s):
-            return s
-        if re.match(r"^\+447\d{9}$", s):
-            return s
-        return np.nan
-    original_mobiles = df["Preferred telephone number"].copy()
-    df["Preferred telephone number"] = df["Preferred telephone number"].apply(clean_mobile)
-    # Warn about corrections and blanked numbers
-    corrected = (original_mobiles != df["Preferred telephone number"]) & (df["Preferred telephone number"] != "")
-    blanked = (df["Preferred telephone number"] == "")
-    if corrected.any():
-        time.sleep(0.3)  # Small delay to ensure toast appears after processing
-        st.toast(
-            "The following row(s) had their mobile number corrected to a valid UK format: " +
-            ", ".join(str(idx) for idx in df[corrected].index.tolist()), icon=":material/build_circle:"
-        )
-    if blanked.any():
-        time.sleep(0.3)
-        st.toast(
-            "The following row(s) had invalid mobile numbers and have been blanked: " +
-            ", ".join(str(idx) for idx in df[blanked].index.tolist()), icon=":material/build_circle:"
-        )
+    # Parse only the required columns and clean them, once per upload; reruns
+    # (e.g. editing the filename) reuse the cached result
+    try:
+        uploaded_preview, uploaded_rows, cleaned_df, warnings = clean_csv(raw)
+    except Exception:
+        st.error("Could not read the CSV file. Please check the format.")
+        st.stop()
 
-    # Extract valid email from any cell with extra text (remove text after first space)
-    def extract_email(cell):
-        s = str(cell).strip()
-        if " " in s:
-            return s.split(" ")[0]
-        return s
-    df["Email address"] = df["Email address"].apply(extract_email)
-    # Replace empty strings or 'nan' (string) with np.nan
-    df["Email address"] = df["Email address"].replace(["", "nan", "NaN", "None"], np.nan)
+    # Display the uploaded data (the required columns only)
+    st.subheader("Uploaded Data")
+    st.dataframe(uploaded_preview, height=200)
+    if uploaded_rows > PREVIEW_ROWS:
+        st.caption(f"Showing first {PREVIEW_ROWS} of {uploaded_rows:,} rows.")
+    st.info(f"Uploaded DataFrame row count: **{uploaded_rows}**")
 
-    # After extraction, warn if any are still blank (could not extract)
-    still_blank_mask = df["Email address"].isna()
-    if still_blank_mask.any():
-        blanked_emails = df.loc[still_blank_mask].index.tolist()
-        time.sleep(0.3)
-        st.toast(
-            f"The following row(s) had no valid email address and have been left blank: {blanked_emails}", icon=":material/build_circle:"
-        )
+    for warning in warnings:
+        st.toast(warning, icon=":material/build_circle:")
 
-    # Check that NHS number is 10 digits long, drop rows that do not match
-    nhs_valid = df["NHS number"].astype(str).str.match(r"^\d{10}$")
-    dropped_count = (~nhs_valid).sum()
-    if dropped_count > 0:
-        time.sleep(0.3)
-        st.toast(f"**{dropped_count}** row(s) dropped due to invalid NHS number (must be exactly 10 digits).", icon=":material/build_circle:")
-    df = df[nhs_valid].reset_index(drop=True)
-
-    # Drop rows where both mobile number and email are missing (treat NaN and empty as missing)
-    mobile_missing = df["Preferred telephone number"].isna() | (df["Preferred telephone number"].astype(str).str.strip() == "")
-    email_missing = df["Email address"].isna() | (df["Email address"].astype(str).str.strip() == "")
-    both_missing = mobile_missing & email_missing
-    both_missing_count = both_missing.sum()
-    if both_missing_count > 0:
-        time.sleep(0.3)
-        st.toast(f"**{both_missing_count}** row(s) dropped because both mobile number and email address were missing.", icon=":material/build_circle:")
-    df = df[~both_missing].reset_index(drop=True)
-
-    # Keep only the required columns in the cleaned DataFrame
-    output_cols = [
-        "NHS number",
-        "Preferred telephone number",
-        "Date of birth",
-        "First name",
-        "Email address"
-    ]
-    cleaned_df = df[output_cols].copy()
     st.divider()
-    time.sleep(0.3)
     st.toast("### Scroll down!!", icon=":material/south:")
     st.subheader(":material/household_supplies: Cleaned Data")
-    st.dataframe(cleaned_df, height=200)
+    st.dataframe(cleaned_df.head(PREVIEW_ROWS), height=200)
+    if len(cleaned_df) > PREVIEW_ROWS:
+        st.caption(f"Showing first {PREVIEW_ROWS} of {len(cleaned_df):,} rows.")
     st.info(f"Cleaned DataFrame row count: **{cleaned_df.shape[0]}**")
 
     st.subheader(":material/download: Download Cleaned CSV")
@@ -141,13 +195,11 @@ else:
         "Enter a name for the downloaded CSV file (optional, without .csv extension):",
         value="acurex_sms_cleaned"
     )
-    # Download button for cleaned CSV
-    csv_buffer = io.StringIO()
-    cleaned_df.to_csv(csv_buffer, index=False)
+    # Download button for cleaned CSV (the CSV is only built when the button is clicked)
     download_name = filename.strip() + ".csv" if filename.strip() else "acurex_sms_cleaned.csv"
     st.download_button(
         label="Download Cleaned CSV",
-        data=csv_buffer.getvalue(),
+        data=lambda: cleaned_csv(raw),
         file_name=download_name,
         mime="text/csv"
     )